@@ -0,0 +1,134 @@
+import os, json, asyncio, inspect, logging
+from typing import Optional, Callable, List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import engine, DATABASE_URL
+
+# Cross-worker change feed: writers publish compact events inside their transaction,
+# every worker keeps one listener that fans them out to in-process subscribers.
+# Postgres: pg_notify + a dedicated LISTEN connection. SQLite: foody_changes table + polling.
+
+CHANNEL = os.getenv("CHANGEFEED_CHANNEL", "foody_changes")
+POLL_SEC = float(os.getenv("CHANGEFEED_POLL_SEC", "1.0"))
+KEEP_ROWS = 1000  # SQLite fallback: how many recent events to keep
+
+RESYNC = '{"t":"resync"}'  # events may have been missed: subscribers should reload their state
+
+log = logging.getLogger(__name__)
+_subscribers: List[Callable] = []
+_task: Optional[asyncio.Task] = None
+
+def is_postgres() -> bool:
+    """True when events go through pg_notify; otherwise the foody_changes table is polled."""
+    return engine.dialect.name == "postgresql"
+
+def subscribe(cb: Callable):
+    """Register `cb(event: dict)` (sync or async); called for every event, from any worker."""
+    _subscribers.append(cb)
+
+def unsubscribe(cb: Callable):
+    if cb in _subscribers:
+        _subscribers.remove(cb)
+
+async def publish(db: AsyncSession, kind: str, op: str, obj_id: str, **extra):
+    """Queue an event in the caller's transaction; it is delivered only if the caller commits."""
+    event = {"t": kind, "op": op, "id": obj_id}
+    event.update({k: v for k, v in extra.items() if v is not None})
+    payload = json.dumps(event, separators=(",", ":"), default=str)
+    if is_postgres():
+        await db.execute(text("SELECT pg_notify(:ch, :p)").bindparams(ch=CHANNEL, p=payload))
+    else:
+        await db.execute(text("INSERT INTO foody_changes(payload) VALUES (:p)").bindparams(p=payload))
+
+async def _dispatch(payload: str):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        log.exception("changefeed: bad payload %r", payload)
+        return
+    for cb in list(_subscribers):
+        try:
+            r = cb(event)
+            if inspect.isawaitable(r):
+                await r
+        except Exception:
+            log.exception("changefeed: subscriber %r failed", cb)  # остальные подписчики всё равно получат событие
+
+async def _drain(queue: asyncio.Queue):
+    while True:
+        await _dispatch(await queue.get())
+
+async def _listen_pg():
+    try:
+        import asyncpg
+    except ImportError:
+        log.exception("changefeed: asyncpg is not installed, LISTEN disabled")
+        return
+    dsn = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+    queue: asyncio.Queue = asyncio.Queue()  # one consumer keeps commit order
+    dispatcher = asyncio.create_task(_drain(queue))
+    backoff = 1.0
+    try:
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn)
+                await conn.add_listener(CHANNEL, lambda _c, _pid, _ch, payload: queue.put_nowait(payload))
+                queue.put_nowait(RESYNC)  # notifications sent while we were not listening are lost
+                backoff = 1.0
+                while True:
+                    await asyncio.sleep(5)
+                    await conn.execute("SELECT 1")  # keepalive; raises if the connection dropped
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("changefeed: LISTEN connection failed, reconnecting in %.0fs", backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+    finally:
+        dispatcher.cancel()
+
+async def _poll_sqlite():
+    last_id = None
+    resync = False
+    while True:
+        try:
+            async with engine.begin() as conn:
+                if last_id is None:
+                    last_id = (await conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM foody_changes"))).scalar_one()
+                rows = (await conn.execute(text("SELECT id, payload FROM foody_changes WHERE id > :i ORDER BY id")
+                                           .bindparams(i=last_id))).all()
+                if rows:
+                    await conn.execute(text("DELETE FROM foody_changes WHERE id <= :i").bindparams(i=rows[-1][0] - KEEP_ROWS))
+            if resync:
+                resync = False
+                await _dispatch(RESYNC)
+            for row_id, payload in rows:
+                last_id = row_id
+                await _dispatch(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("changefeed: polling foody_changes failed")
+            resync = True
+        await asyncio.sleep(POLL_SEC)
+
+async def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_listen_pg() if is_postgres() else _poll_sqlite())
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
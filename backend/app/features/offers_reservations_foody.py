@@ -1,4 +1,4 @@
-import os, math, uuid, secrets, random, string
+import os, math, uuid, secrets, random, string, asyncio, hashlib, logging
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List
 
@@ -8,9 +8,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, text
 
 from ..db import get_db, engine
-from ..models import FoodyRestaurant, FoodyOffer, FoodyReservation
+from ..models import FoodyRestaurant, FoodyOffer, FoodyReservation, FoodyIdempotency, FoodyChange
+from .. import changefeed
 
 router = APIRouter(prefix="/api/v1", tags=["foody"])
+log = logging.getLogger(__name__)
 
 # ---------- helpers ----------
 def _now_utc() -> datetime:
@@ -42,9 +44,91 @@ async def _auth_restaurant(db: AsyncSession, restaurant_id: str, api_key: Option
 # ---------- DB bootstrap (simple create if not exists) ----------
 async def ensure_schema():
     async with engine.begin() as conn:
-        await conn.run_sync(FoodyRestaurant.metadata.create_all, checkfirst=True)
-        await conn.run_sync(FoodyOffer.metadata.create_all, checkfirst=True)
-        await conn.run_sync(FoodyReservation.metadata.create_all, checkfirst=True)
+        tables = [FoodyRestaurant.__table__, FoodyOffer.__table__, FoodyReservation.__table__, FoodyIdempotency.__table__]
+        if not changefeed.is_postgres():
+            tables.append(FoodyChange.__table__)  # only the SQLite polling fallback needs the change log
+        await conn.run_sync(FoodyRestaurant.metadata.create_all, tables=tables, checkfirst=True)
+
+# ---------- idempotency (Idempotency-Key header) ----------
+IDEMPOTENCY_TTL_SEC = int(os.getenv("IDEMPOTENCY_TTL_SEC", "86400"))
+IDEMPOTENCY_SWEEP_SEC = int(os.getenv("IDEMPOTENCY_SWEEP_SEC", "3600"))
+_idem_inflight: dict = {}  # key -> Future, завершается после commit/rollback владельца ключа
+_idem_sweeper: Optional[asyncio.Task] = None
+
+async def _idem_sweep_loop():
+    while True:
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text("DELETE FROM foody_idempotency WHERE created_at < :ttl")
+                                   .bindparams(ttl=_now_utc() - timedelta(seconds=IDEMPOTENCY_TTL_SEC)))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("idempotency: sweeping expired keys failed")
+        await asyncio.sleep(IDEMPOTENCY_SWEEP_SEC)
+
+async def start_idempotency_sweeper():
+    global _idem_sweeper
+    if _idem_sweeper is None:
+        _idem_sweeper = asyncio.create_task(_idem_sweep_loop())
+
+async def stop_idempotency_sweeper():
+    global _idem_sweeper
+    if _idem_sweeper is not None:
+        _idem_sweeper.cancel()
+        try:
+            await _idem_sweeper
+        except asyncio.CancelledError:
+            pass
+        _idem_sweeper = None
+
+def _idem_fingerprint(body: BaseModel) -> str:
+    return hashlib.sha256(body.model_dump_json().encode()).hexdigest()
+
+async def _idempotent(db: AsyncSession, scope: str, idem_key: Optional[str], body: BaseModel, out_cls, run):
+    """Run `run()` at most once per (scope, Idempotency-Key) and commit it on `db` together with
+    the stored response; replays get the stored response back."""
+    if idem_key is None:
+        out = await run()
+        await db.commit()
+        return out
+    idem_key = idem_key.strip()
+    if not idem_key or len(idem_key) > 128:
+        raise HTTPException(422, "Idempotency-Key must be 1..128 chars")
+    k = hashlib.sha256(f"{scope}:{idem_key}".encode()).hexdigest()  # fixed length whatever the scope is
+    fp = _idem_fingerprint(body)
+    # duplicates inside this worker wait for the owner without holding a pooled connection
+    while (fut := _idem_inflight.get(k)) is not None:
+        await db.rollback()
+        await asyncio.shield(fut)
+    fut = asyncio.get_running_loop().create_future()
+    _idem_inflight[k] = fut
+    try:
+        await db.execute(text("DELETE FROM foody_idempotency WHERE idem_key=:k AND created_at < :ttl")
+                         .bindparams(k=k, ttl=_now_utc() - timedelta(seconds=IDEMPOTENCY_TTL_SEC)))
+        # The claim row is written in the request transaction. A concurrent INSERT of the same key
+        # blocks on it: if the owner commits we read its response, if it rolls back the key is ours.
+        res = await db.execute(text("INSERT INTO foody_idempotency(idem_key, fingerprint, created_at) VALUES (:k,:f,:n) ON CONFLICT (idem_key) DO NOTHING")
+                               .bindparams(k=k, f=fp, n=_now_utc()))
+        if not res.rowcount:
+            row = (await db.execute(text("SELECT fingerprint, body FROM foody_idempotency WHERE idem_key=:k").bindparams(k=k))).fetchone()
+            await db.rollback()
+            if not row or row[1] is None:
+                raise HTTPException(409, "Request with this Idempotency-Key is in progress")
+            if row[0] != fp:
+                raise HTTPException(422, "Idempotency-Key was already used with a different request")
+            return out_cls.model_validate_json(row[1])
+        try:
+            out = await run()
+            await db.execute(text("UPDATE foody_idempotency SET body=:b WHERE idem_key=:k").bindparams(b=out.model_dump_json(), k=k))
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        return out
+    finally:
+        _idem_inflight.pop(k, None)
+        fut.set_result(None)
 
 # ---------- models in/out ----------
 class RegisterRestaurantIn(BaseModel):
@@ -119,6 +203,7 @@ async def register_restaurant(body: RegisterRestaurantIn, db: AsyncSession = Dep
     key = _gen_api_key()
     await db.execute(text("INSERT INTO foody_restaurants(id, title, api_key, lat, lng) VALUES (:i,:t,:k,:la,:ln)")
                      .bindparams(i=rid, t=body.title.strip(), k=key, la=body.lat, ln=body.lng))
+    await changefeed.publish(db, "restaurant", "create", rid)
     await db.commit()
     return RegisterRestaurantOut(restaurant_id=rid, api_key=key, title=body.title)
 
@@ -165,6 +250,7 @@ async def merchant_create_offer(
     oid = _gen_offer_id()
     await db.execute(text("INSERT INTO foody_offers(id, restaurant_id, title, price_cents, original_price_cents, qty_total, qty_left, expires_at) VALUES (:i,:r,:t,:p,:op,:qt,:ql,:e)")
                      .bindparams(i=oid, r=body.restaurant_id, t=body.title.strip(), p=price_cents, op=orig_cents, qt=qty_total, ql=qty_left, e=body.expires_at))
+    await changefeed.publish(db, "offer", "create", oid, rid=body.restaurant_id)
     await db.commit()
     o = (await db.execute(select(FoodyOffer).where(FoodyOffer.id==oid))).scalar_one()
     return MerchantOfferOut(id=o.id, restaurant_id=o.restaurant_id, title=o.title, price_cents=o.price_cents, original_price_cents=o.original_price_cents, qty_total=o.qty_total, qty_left=o.qty_left, expires_at=o.expires_at, created_at=o.created_at)
@@ -215,7 +301,9 @@ async def merchant_edit_offer(
         return MerchantOfferOut(id=o.id, restaurant_id=o.restaurant_id, title=o.title, price_cents=o.price_cents, original_price_cents=o.original_price_cents, qty_total=o.qty_total, qty_left=o.qty_left, expires_at=o.expires_at, created_at=o.created_at)
 
     q="UPDATE foody_offers SET "+", ".join(sets)+" WHERE id=:id"
-    await db.execute(text(q).bindparams(**params)); await db.commit()
+    await db.execute(text(q).bindparams(**params))
+    await changefeed.publish(db, "offer", "update", offer_id, rid=row[0])
+    await db.commit()
     o=(await db.execute(select(FoodyOffer).where(FoodyOffer.id==offer_id))).scalar_one()
     return MerchantOfferOut(id=o.id, restaurant_id=o.restaurant_id, title=o.title, price_cents=o.price_cents, original_price_cents=o.original_price_cents, qty_total=o.qty_total, qty_left=o.qty_left, expires_at=o.expires_at, created_at=o.created_at)
 
@@ -239,6 +327,7 @@ async def merchant_delete_offer(
         else:
             await db.execute(text("DELETE FROM foody_reservations WHERE offer_id=:id").bindparams(id=offer_id))
             await db.execute(text("DELETE FROM foody_offers WHERE id=:id").bindparams(id=offer_id))
+        await changefeed.publish(db, "offer", "archive" if cnt else "delete", offer_id, rid=row[0])
         await db.commit()
         return {"ok": True, "deleted_id": offer_id, "archived": bool(cnt)}
     except Exception as e:
@@ -318,7 +407,13 @@ async def public_offers(
     return out
 
 @router.post("/reservations", response_model=ReservationOut)
-async def create_reservation(body: CreateReservationIn, db: AsyncSession = Depends(get_db)):
+async def create_reservation(body: CreateReservationIn,
+                             idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                             db: AsyncSession = Depends(get_db)):
+    return await _idempotent(db, f"reservations:{body.buyer_tg_id or ''}", idempotency_key, body, ReservationOut,
+                             lambda: _create_reservation(body, db))
+
+async def _create_reservation(body: CreateReservationIn, db: AsyncSession) -> ReservationOut:
     o=(await db.execute(select(FoodyOffer).where(FoodyOffer.id==body.offer_id))).scalar_one_or_none()
     if not o: raise HTTPException(404, "Offer not found")
     if o.qty_left<=0: raise HTTPException(409, "Sold out")
@@ -330,7 +425,7 @@ async def create_reservation(body: CreateReservationIn, db: AsyncSession = Depen
     await db.execute(text("UPDATE foody_offers SET qty_left=qty_left-1 WHERE id=:id").bindparams(id=o.id))
     await db.execute(text("INSERT INTO foody_reservations(id, offer_id, restaurant_id, code, status, buyer_tg_id, expires_at) VALUES (:i,:o,:r,:c,'reserved',:b,:e)")
                      .bindparams(i=res_id, o=o.id, r=rid, c=code, b=body.buyer_tg_id, e=exp))
-    await db.commit()
+    await changefeed.publish(db, "offer", "qty", o.id, rid=rid)
     return ReservationOut(id=res_id, code=code, status="reserved", offer_id=o.id, expires_at=exp)
 
 class RedeemIn(BaseModel):
@@ -361,10 +456,15 @@ async def merchant_check_code(restaurant_id: Optional[str] = Query(None), code:
 
 @router.post("/merchant/redeem", response_model=RedeemOut)
 async def merchant_redeem(body: RedeemIn, x_foody_key: Optional[str] = Header(None, alias="X-Foody-Key"), key: Optional[str] = Query(None),
+                          idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
                           db: AsyncSession = Depends(get_db)):
     api_key = x_foody_key or key
     rid_by_key = await _auth_key_to_restaurant(db, api_key)
     if not rid_by_key: raise HTTPException(401, "Missing auth")
+    return await _idempotent(db, f"redeem:{rid_by_key}", idempotency_key, body, RedeemOut,
+                             lambda: _merchant_redeem(body, rid_by_key, db))
+
+async def _merchant_redeem(body: RedeemIn, rid_by_key: str, db: AsyncSession) -> RedeemOut:
     cond=""
     if body.res_id: cond="id=:v"
     elif body.code: cond="code=:v"
@@ -373,7 +473,6 @@ async def merchant_redeem(body: RedeemIn, x_foody_key: Optional[str] = Header(No
     if not row: raise HTTPException(404, "Not found")
     if row[2]=="redeemed": return RedeemOut(ok=True, reservation_id=row[0], code=row[1], status=row[2])
     await db.execute(text("UPDATE foody_reservations SET status='redeemed', redeemed_at=NOW() WHERE id=:i").bindparams(i=row[0]))
-    await db.commit()
     return RedeemOut(ok=True, reservation_id=row[0], code=row[1], status="redeemed")
 
 
@@ -402,6 +501,7 @@ async def merchant_staff_pin(
     import random
     pin = "".join(str(random.randint(0,9)) for _ in range(6))
     await db.execute(text("UPDATE foody_restaurants SET staff_pin=:pin WHERE id=:rid").bindparams(pin=pin, rid=rid))
+    await changefeed.publish(db, "restaurant", "staff_pin", rid)
     await db.commit()
     return StaffPinOut(ok=True, restaurant_id=rid, staff_pin=pin)
 
@@ -461,14 +561,19 @@ async def staff_redeem(
     await db.commit()
     return StaffRedeemOut(ok=True, reservation_id=rid_res, code=body.code, status="redeemed")
 
-@router.post("/api/v1/merchant/offers/{offer_id}/restore")
-async def restore_offer(offer_id: str, request: Request, restaurant_id: str = Query(...)):
-    key = request.headers.get("X-Foody-Key")
-    await _auth_key(restaurant_id, key)
-    async with async_session() as s:
-        o = await s.get(FoodyOffer, offer_id)
-        if not o or o.restaurant_id != restaurant_id:
-            raise HTTPException(404, "Offer not found")
-        o.archived_at = None
-        await s.commit()
-        return {"ok": True, "restored_id": offer_id}
+@router.post("/merchant/offers/{offer_id}/restore")
+async def restore_offer(
+    offer_id: str,
+    restaurant_id: str = Query(...),
+    x_foody_key: Optional[str] = Header(None, alias="X-Foody-Key"),
+    key: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_db)
+):
+    await _auth_restaurant(db, restaurant_id, x_foody_key or key)
+    o = await db.get(FoodyOffer, offer_id)
+    if not o or o.restaurant_id != restaurant_id:
+        raise HTTPException(404, "Offer not found")
+    o.archived_at = None
+    await changefeed.publish(db, "offer", "restore", offer_id, rid=restaurant_id)
+    await db.commit()
+    return {"ok": True, "restored_id": offer_id}
@@ -2,7 +2,7 @@
 from __future__ import annotations
 from typing import Optional, List
 from datetime import datetime
-from sqlalchemy import String, ForeignKey, DateTime, Integer
+from sqlalchemy import String, ForeignKey, DateTime, Integer, Text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
@@ -54,3 +54,15 @@ class FoodyReservation(Base):
     redeemed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
     offer: Mapped["FoodyOffer"] = relationship(back_populates="reservations")
+
+class FoodyIdempotency(Base):
+    __tablename__ = "foody_idempotency"
+    idem_key: Mapped[str] = mapped_column(String(64), primary_key=True)  # sha256("<scope>:<Idempotency-Key>")
+    fingerprint: Mapped[str] = mapped_column(String(64))  # sha256 тела запроса
+    body: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # пишется в той же транзакции, что и сам запрос
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True)
+
+class FoodyChange(Base):
+    __tablename__ = "foody_changes"  # журнал событий для polling-режима changefeed (SQLite)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    payload: Mapped[str] = mapped_column(Text)
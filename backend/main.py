@@ -3,7 +3,8 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from app.db import engine
-from app.features.offers_reservations_foody import router, ensure_schema
+from app.features.offers_reservations_foody import router, ensure_schema, start_idempotency_sweeper, stop_idempotency_sweeper
+from app import changefeed
 
 app = FastAPI(title="Foody Backend", version="v10")
 
@@ -21,6 +22,13 @@ app.add_middleware(
 @app.on_event("startup")
 async def _boot():
     await ensure_schema()
+    await changefeed.start()
+    await start_idempotency_sweeper()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await changefeed.stop()
+    await stop_idempotency_sweeper()
 
 @app.get("/health")
 async def health(): return {"ok": True}